@@ -1,20 +1,31 @@
 #!/usr/bin/env python3
+import asyncio
+import hashlib
+import importlib.util
+import json
+import operator
 import traceback
 from time import time
 import yaml
-from ollama import Client
+from ollama import AsyncClient
 import re
 import sys
+import threading
 import zipfile
 import os
+import queue
+import shutil
 import torch
 from diffusers import StableDiffusion3Pipeline
+from jinja2 import Environment
 
 
 class Dialogue:
     """
     Represents a single line of dialogue. Includes the name of the character speaking if it exists.
     """
+    __slots__ = ("_speaker", "_line")
+
     def __init__(self, line, speaker=None):
         """
         Constructor of the Dialogue class.
@@ -40,11 +51,11 @@ class Dialogue:
         """
         The line as it should be added in the current Ren'Py project.
 
-        :param characters: The list of characters in this Ren'Py project.
+        :param characters: The index of each character in this Ren'Py project, by name.
         :return: The line as it should be added in the current Ren'Py project.
         """
         if self._speaker:
-            c_index = characters.index(self._speaker)
+            c_index = characters[self._speaker]
             return f'c{c_index} "{self._line}"'
         else:
             return f'"{self._line}"'
@@ -56,6 +67,8 @@ class Situation:
     """
     Represents a question and its answers, generally obtained from the YAML file.
     """
+    __slots__ = ("_question", "_answers", "_correct_answer_index", "_introduction", "_endings", "_characters",
+                 "_introduction_text", "_good_story")
 
     def __init__(self, question: str, correct_answer_index: int, answers: tuple):
         """
@@ -76,6 +89,8 @@ class Situation:
         self._introduction = None
         self._endings = None
         self._characters = set()
+        self._introduction_text = None
+        self._good_story = None
 
     @property
     def question(self):
@@ -102,6 +117,15 @@ class Situation:
         """:obj:`list` of :obj:`Dialogue` he generated introduction for this Situation. Should be assigned by parse()."""
         return self._introduction
 
+    @property
+    def introduction_text(self):
+        """str: the lines of the introduction, joined. Computed once, after parse()."""
+        if self._introduction is None:
+            raise AttributeError("Introduction undefined - have you run parse()?")
+        if self._introduction_text is None:
+            self._introduction_text = "\n".join([str(x) for x in self._introduction])
+        return self._introduction_text
+
     @property
     def endings(self):
         """:obj:`list` of :obj:`str`: the tuple storing all endings of this Situation. Should be assigned by parse().
@@ -122,8 +146,9 @@ class Situation:
         """
         if self._introduction is None or self._endings is None:
             raise AttributeError("Introduction and/or endings undefined - have you run parse()?")
-        story = "\n".join([str(x) for x in self.introduction + [self.correct_answer] + self.good_ending])
-        return story
+        if self._good_story is None:
+            self._good_story = "\n".join([str(x) for x in self.introduction + [self.correct_answer] + self.good_ending])
+        return self._good_story
 
     @property
     def characters(self):
@@ -135,331 +160,899 @@ class Situation:
         :param story: the generated story.
         :type story: str
         """
-        story_per_line = story.split("\n")
-        dialogues_dict = dict()  # Dictionary line => dialogue
-        i = story_per_line.index("| Speaker | Dialogue |") + 2  # skipping header of table and "|---|---|" line
-        while True:
-            if i == len(story_per_line) or not story_per_line[i].strip():
-                break
-            line = story_per_line[i][2:-2].split("|")
-            speaker = line[0].strip()
-            dialogue = line[1].strip()
-
-            #escaped_dialogue = re.escape(dialogue)
-            #words = escaped_dialogue.split(" ")
-            words = dialogue.split()
-
-            # pattern = r'\b.*?\b'.join(words)
-            pattern = r""
-            for word in words[:-1]:
-                pattern += re.escape(word)
-                pattern += r'.*?'
-            pattern += words[-1]
-
-            dialogues_dict[pattern] = speaker
-            i += 1
+        # The speakers of a story that failed to be parsed before mustn't be kept.
+        self._characters = set()
+        # Removed once for the whole story, since lone surrogates can't be written to the UTF-8 script.
+        story_per_line = SURROGATE_RE.sub("", story).split("\n")
+        # (row, words of the line, speaker) of each row of the table, grouped by the first word of the line. Rows are
+        # kept rather than keyed by line, as a line can be said twice.
+        dialogues = dict()
+        row = 0
+        # Non-empty lines of each section. A section ends with the next markdown header.
+        sections = dict()
+        section = None
+        # Where the previous line is relative to the table: before its header, on its header, in its rows or after it.
+        table = "before"
+        # The table and the sections are gathered in a single pass over the story.
+        for line in story_per_line:
+            if table == "rows":
+                if line.strip():
+                    cells = line[2:-2].split("|")
+                    speaker = cells[0].strip()
+                    dialogue = cells[1].strip()
+
+                    # The line is found in the story if its words appear in the same order, since the story adds
+                    # punctuation and narration around them.
+                    words = dialogue.split()
+                    if words:
+                        dialogues.setdefault(words[0], list()).append((row, words, speaker))
+                        self._characters.add(speaker)
+                        row += 1
+                else:
+                    table = "after"
+            elif table == "header":
+                table = "rows"  # skipping the "|---|---|" line
+            elif table == "before" and line == "| Speaker | Dialogue |":
+                table = "header"
+                # The table ends the current section even without a markdown header, so that its lines never become
+                # lines of the story. A title in bold right before it belongs to the table too.
+                if section and section[-1].strip().startswith("**") and section[-1].strip().endswith("**"):
+                    section.pop()
+                section = None
+
+            if line.startswith("##"):
+                # Only the first section with this header is kept, the lines of a repeated one are ignored.
+                header = line.strip()
+                if header not in sections:
+                    section = sections[header] = list()
+                else:
+                    section = None
+            elif section is not None and line.strip():
+                section.append(line)
+        if table == "before":
+            raise ValueError("The story has no table of dialogues")
 
         # introduction
-        i = story_per_line.index("## Introduction") + 2
-        self._introduction = list()
-        while True:
-            if story_per_line[i].startswith("##") or story_per_line[i+1].startswith("## "):
-                break
-
-            if not story_per_line[i].strip():
-                i += 1
-                continue
-
-            for pattern, speaker in dialogues_dict.items():
-                added = False
-                self._characters.add(speaker)
-                if re.search(pattern, story_per_line[i], re.DOTALL):
-                    dialogue_line = Dialogue(story_per_line[i], speaker)
-                    self._introduction.append(dialogue_line)
-                    added = True
-                    break
-
-            if added:
-                dialogues_dict.pop(pattern)
-            else:
-                dialogue_line = Dialogue(story_per_line[i])
-                self._introduction.append(dialogue_line)
-
-            i += 1
+        self._introduction_text = None
+        self._good_story = None
+        self._introduction = [self._dialogue(line, dialogues) for line in sections["## Introduction"]]
 
         # endings
         self._endings = list()
         for i in range(len(self._answers)):
-            j = story_per_line.index(f"## Ending with answer {i}") + 2
-            ending = list()
-            while True:
-                if story_per_line[j].startswith("## ") or story_per_line[j+1].startswith("## "):
+            ending = [self._dialogue(line, dialogues) for line in sections[f"## Ending with answer {i}"]]
+            self._endings.append(ending)
+
+    @staticmethod
+    def _dialogue(line, dialogues):
+        """Makes the Dialogue of a line of the story.
+
+        The speaker is the one of the first dialogue of the table found in the line, which is then removed from
+        dialogues so that it isn't found again. A single search of each first word rules out all the dialogues starting
+        with it, so only the remaining candidates are searched for entirely.
+
+        :param line: the line of the story.
+        :param dialogues: the (row, words of the line, speaker) of the dialogues of the table not found yet, grouped by
+            the first word of the line and sorted by row.
+        :return: the Dialogue, without speaker if no dialogue of the table is found in the line.
+        """
+        found = None  # (row, first word, index in its group, speaker) of the first dialogue found.
+        for first_word, rows in dialogues.items():
+            if first_word not in line:
+                continue
+            for i, (row, words, speaker) in enumerate(rows):
+                if found is not None and row > found[0]:
+                    break
+                if contains_in_order(line, words):
+                    found = (row, first_word, i, speaker)
                     break
-                if story_per_line[j] == "":
-                    j += 1
-                    continue
-
-                for pattern, speaker in dialogues_dict.items():
-                    added = False
-                    self._characters.add(speaker)
-                    if re.search(pattern, story_per_line[j], re.DOTALL):
-                        dialogue_line = Dialogue(story_per_line[j], speaker)
-                        ending.append(dialogue_line)
-                        added = True
-                        break
-
-                if added:
-                    dialogues_dict.pop(pattern)
-                else:
-                    dialogue_line = Dialogue(story_per_line[j])
-                    ending.append(dialogue_line)
 
-                j += 1
-            self._endings.append(ending)
+        if found is None:
+            return Dialogue(line)
+        _, first_word, i, speaker = found
+        del dialogues[first_word][i]
+        if not dialogues[first_word]:
+            del dialogues[first_word]
+        return Dialogue(line, speaker)
+
+# Number of background images generated at once by Stable Diffusion 3. Lower it if the GPU runs out of memory.
+BACKGROUND_BATCH_SIZE = 2
+# VRAM needed to keep the whole Stable Diffusion 3 pipeline on the GPU, in bytes. With less free VRAM, each of its
+# models is only moved to the GPU while it runs.
+SD3_VRAM = 18 * 1024 ** 3
+# base.zip is only extracted once per version, in a subdirectory of this one, which is then copied for each game.
+BASE_GAME_DIR = "base-extracted"
+# Files of the base game that neither this script nor Ren'Py ever modify, so they can be hard linked instead of copied.
+LINKED_EXTENSIONS = (".png", ".jpg", ".webp", ".ttf", ".otf", ".ogg", ".opus", ".mp3", ".wav")
+# Fields of a situation in the YAML file.
+SITUATION_FIELDS = operator.itemgetter("question", "answers", "correct_answer")
+# How long Ollama keeps a model loaded after a request. The models are unloaded by unload() once they aren't needed.
+KEEP_ALIVE = "20m"
+# Directory where the responses of Ollama are kept until the game is generated, so that an interrupted run can resume.
+RESPONSE_CACHE_DIR = "responses-cache"
+# Models that were sent a request during this run, so that they are loaded by Ollama.
+loaded_models = set()
+# Number of times a request to Ollama is sent before giving up on it.
+MAX_RETRIES = 5
+# Gemma 2 has a context window of 8192 tokens, all of it is needed by the batched stories.
+STORY_MODEL_CONTEXT = 8192
+# Rough upper bound of the number of tokens needed to write the introduction of a story, and each of its endings with
+# their lines in the table. A story with 4 answers gets 2048 tokens.
+STORY_INTRODUCTION_TOKENS = 768
+STORY_ENDING_TOKENS = 320
+# Llama 3 only gets a story and the keywords or the transition it writes. Ollama reloads a model whenever num_ctx
+# changes, so each model always gets the same one.
+LLAMA3_CONTEXT = 4096
+# Upper bounds of the number of tokens of a background prompt and of a transition.
+BACKGROUND_PROMPT_TOKENS = 256
+TRANSITION_TOKENS = 1024
+# Identifier of each story in a batched response, e.g. "[0]" on its own line.
+STORY_ID_RE = re.compile(r"^\[(\d+)\][^\n]*$", re.MULTILINE)
+# A lone UTF-16 surrogate, which can't be encoded in UTF-8.
+SURROGATE_RE = re.compile("[\ud800-\udfff]")
+# A run of blank lines, with the new lines around it.
+BLANK_LINES_RE = re.compile(r"\n\s*\n+")
+# Every non-empty line of a text, turned into a line of dialogue by say_lines().
+SAY_LINE_RE = re.compile(r"^[^\n].*$", re.MULTILINE)
+
+STORY_RULES = "The other answers are wrong answers and must always lead to a bad ending, with severe " \
+              "consequences for all the characters involved. Write the story with an introduction, leading to " \
+              "the choice to make. You have to write all the different endings each option lead to. Do not reword " \
+              "the choices. The good ending must be at least 3 paragraphs long. The story must be " \
+              "written in a third person point of view. The story must be more dialogue than description " \
+              "because it is a visual novel. For each line, one character can talk at most. The format " \
+              "should be markdown. After finishing the story, " \
+              "list all the dialogues with the speakers name, preferably in a table."
+# Prompt asking for the story of a single situation, filled by story_prompt().
+STORY_PROMPT = "Create a story based on this question: {question}. The possible answers are:\n" \
+               "{answers}" \
+               "The correct answer is {correct_answer} and is the only one to lead to a good ending. " \
+               f"{STORY_RULES}" \
+               "The format of the story should be this " \
+               "(replace each part of the format by the corresponding element):\n" \
+               "{format}"
+# Prompt asking for the stories of several situations at once, filled by batch_story_prompt().
+BATCH_STORY_PROMPT = "Create a story for each of the following questions. Each question starts with its identifier " \
+                     "between square brackets. For each question, only the correct answer leads to a good ending. " \
+                     f"{STORY_RULES} Start each story with the identifier of its question alone on a line " \
+                     "(for example: [0]), then write the story in the format given with its question " \
+                     "(replace each part of the format by the corresponding element).\n{questions}"
+# A situation in BATCH_STORY_PROMPT.
+BATCH_STORY_QUESTION = "\n[{id}] Question: {question}\nThe possible answers are:\n{answers}" \
+                       "The correct answer is {correct_answer}.\nFormat:\n{format}"
+
+
+def say_lines(text):
+    """Turns each non-empty line of a text into a line of dialogue said by the narrator in the Ren'Py script.
+
+    :param text: the text, with its quotes already escaped.
+    :return: the lines of dialogue.
+    """
+    return SAY_LINE_RE.sub(r'    "\g<0>"', text)
+
+
+# The Ren'Py script of the game, compiled once. The characters are named c0, c1... after their index in characters,
+# and situation i is made of the labels story{i} for its introduction and s{i}a{j} for the ending of its answer j.
+SCRIPT_TEMPLATE = Environment(trim_blocks=True, lstrip_blocks=True, keep_trailing_newline=True).from_string("""\
+{% for character, index in characters.items() %}
+define c{{ index }} = Character("{{ character }}")
+{% endfor %}
+label start:
+    jump story0
+{% for situation in situations %}
+{% set i = loop.index0 %}
+{% set is_last = loop.last %}
+label story{{ i }}:
+    scene bg{{ i }} at image_upscale
+    with dissolve
+{% for line in situation.introduction %}
+    {{ line.renpy_line(characters) }}
+{% endfor %}
+    menu:
+{% for answer in situation.answers %}
+        "{{ answer }}":
+            jump s{{ i }}a{{ loop.index0 }}
+{% endfor %}
+{% for ending in situation.endings %}
+{% set j = loop.index0 %}
+label s{{ i }}a{{ j }}:
+{% for line in ending %}
+    {{ line.renpy_line(characters) }}
+{% endfor %}
+{% if j != situation.correct_answer_index %}
+    jump story{{ i }}
+{% elif is_last %}
+    jump ending
+{% else %}
+{{ say_lines(transitions[i]) }}
+    jump story{{ i + 1 }}
+{% endif %}
+{% endfor %}
+{% endfor %}
+label ending:
+    "Thanks for playing!"
+""")
+SCRIPT_TEMPLATE.globals["say_lines"] = say_lines
+
+
+def link_or_copy(src, dst):
+    """Copies a file of the base game, or hard links it if it is never modified and the file system supports it.
+
+    :param src: the path of the file in BASE_GAME_DIR.
+    :param dst: the path of the file in the new game.
+    :return: dst.
+    """
+    if src.lower().endswith(LINKED_EXTENSIONS):
+        try:
+            os.link(src, dst)
+            return dst
+        except OSError:
+            pass
+    return shutil.copy2(src, dst)
 
-if __name__ == '__main__':
-    # reading questions
-    with open("questions.yaml", "r") as file:
-        questions_yaml = yaml.safe_load(file)
 
-    # Parsing the YAML file.
-    situations = list()
-    for situation in questions_yaml['situations']:
-        question = situation["question"]
-        answers = tuple(situation["answers"])
-        correct_answer = situation["correct_answer"]
-        obj = Situation(question, correct_answer, answers)
-        situations.append(obj)
+def copy_base_game(game_name):
+    """Copies the base game into the directory of a new game, extracting base.zip first if this version of it has
+    never been.
+
+    :param game_name: the directory of the new game.
+    """
+    # A modified base.zip has another size or modification time, so it is extracted again.
+    stat = os.stat("base.zip")
+    base_dir = f"{BASE_GAME_DIR}/{stat.st_size}-{stat.st_mtime_ns}"
+    if not os.path.isdir(base_dir):
+        # Removing the previous versions. Some of their files may be kept, when a game linked to them is running.
+        shutil.rmtree(BASE_GAME_DIR, ignore_errors=True)
+        # Extracted next to it first, so that an interrupted extraction is never mistaken for a complete one.
+        tmp_dir = f"{BASE_GAME_DIR}-tmp"
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        with zipfile.ZipFile("base.zip", "r") as f:
+            f.extractall(tmp_dir)
+        os.makedirs(BASE_GAME_DIR, exist_ok=True)
+        os.rename(tmp_dir, base_dir)
+    shutil.copytree(base_dir, game_name, copy_function=link_or_copy)
+
+
+def load_questions(path):
+    """Loads the YAML file containing the questions.
+
+    The parsed file is cached next to it as JSON, which loads much faster, and is only parsed again when the YAML file
+    has another size or modification time than when it was cached.
+
+    :param path: the path of the YAML file.
+    :return: the content of the YAML file.
+    """
+    cache_path = f"{path}.json"
+    # An exact match is required, since a file copied or moved over the YAML file can keep an older modification time.
+    stat = os.stat(path)
+    version = f"{stat.st_size}-{stat.st_mtime_ns}"
+    if os.path.exists(cache_path):
+        try:
+            with open(cache_path, "r", encoding="utf8") as file:
+                cache = json.load(file)
+        except ValueError:
+            # A broken cache is parsed again.
+            cache = None
+        if isinstance(cache, dict) and cache.get("version") == version:
+            return cache["questions"]
+
+    # libyaml's C loader is much faster than the pure Python one, but is only available if PyYAML was built with it.
+    Loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+    with open(path, "r") as file:
+        questions_yaml = yaml.load(file, Loader=Loader)
+    try:
+        cache = json.dumps({"version": version, "questions": questions_yaml})
+    except TypeError:
+        # Some YAML values, such as dates, can't be stored as JSON. The file is then parsed at every run.
+        return questions_yaml
+    # Written under another name first, so that an interrupted run doesn't leave a truncated cache.
+    with open(f"{cache_path}.tmp", "w", encoding="utf8") as file:
+        file.write(cache)
+    os.replace(f"{cache_path}.tmp", cache_path)
+    return questions_yaml
+
+
+def contains_in_order(text, words):
+    """Checks whether words all appear in text, in the same order, with anything between them.
+
+    This is a single left to right scan with str.find, which can't backtrack like the equivalent regex.
+
+    :param text: the text to search in.
+    :param words: the words to find.
+    :return: True if all the words were found in order.
+    """
+    position = 0
+    for word in words:
+        position = text.find(word, position)
+        if position < 0:
+            return False
+        position += len(word)
+    return True
+
+
+def estimate_tokens(text):
+    """Roughly estimates the number of tokens of a text, assuming about 4 characters per token.
+
+    :param text: the text to estimate.
+    :return: the estimated number of tokens.
+    """
+    return len(text) // 4 + 1
+
+
+def answer_list(situation):
+    """The numbered list of the possible answers of a situation, one per line.
+
+    :param situation: the situation to list the answers of.
+    :return: the list, ending with a new line.
+    """
+    return "".join(f"{i}. {answer}\n" for i, answer in enumerate(situation.answers))
+
+
+def story_format(situation):
+    """The sections the story of a situation must be written in, one per line.
+
+    :param situation: the situation to write the story of.
+    :return: the sections, ending with a new line.
+    """
+    # Better results if we're explicitly asking for each answer
+    endings = "".join(f"## Ending with answer {i}\n" for i in range(len(situation.answers)))
+    return f"## Introduction\n{endings}## Dialogues\n"
+
+
+def story_prompt(situation):
+    """The prompt asking for the story of a single situation.
+
+    :param situation: the situation to write the story of.
+    :return: the prompt.
+    """
+    return STORY_PROMPT.format(
+        question=situation.question,
+        answers=answer_list(situation),
+        correct_answer=situation.correct_answer,
+        format=story_format(situation)
+    )
+
+
+def batch_story_prompt(situations):
+    """The prompt asking for the stories of several situations at once.
+
+    The instructions are only written once, then each situation is listed after its identifier ([0], [1]...),
+    which the model has to repeat before each story so that the response can be split by split_story_batch().
+
+    :param situations: the situations to write the stories of.
+    :return: the prompt.
+    """
+    questions = "".join(
+        BATCH_STORY_QUESTION.format(
+            id=i,
+            question=situation.question,
+            answers=answer_list(situation),
+            correct_answer=situation.correct_answer,
+            format=story_format(situation)
+        )
+        for i, situation in enumerate(situations)
+    )
+    return BATCH_STORY_PROMPT.format(questions=questions)
+
+
+def split_story_batch(content):
+    """Splits a response to batch_story_prompt() into the story of each situation.
+
+    :param content: the generated response.
+    :return: a dictionary mapping the identifier of each situation to its story.
+    """
+    stories = dict()
+    matches = list(STORY_ID_RE.finditer(content))
+    for i in range(len(matches)):
+        end = matches[i + 1].start() if i + 1 < len(matches) else len(content)
+        stories[int(matches[i].group(1))] = content[matches[i].end():end].strip("\n")
+    return stories
+
+
+def story_tokens(situation):
+    """Roughly estimates the number of tokens needed to write the story of a situation, which has one ending per answer.
+
+    :param situation: the situation to write the story of.
+    :return: the estimated number of tokens.
+    """
+    return STORY_INTRODUCTION_TOKENS + len(situation.answers) * STORY_ENDING_TOKENS
 
-    # Instanciating the ollama client.
-    ollama_client = Client(host="http://localhost:11434", timeout=20 * 60)  # 20 minutes of timeout
 
-    # Creating lists to store the transitions and the prompts for the background images.
-    transitions = list()
-    background_prompts = list()
+def story_batches(situations):
+    """Groups the situations so that the stories of each group can be generated by a single request.
 
-    # Generating a story for each situation
-    while True:
+    A group is only extended while its prompt and all of its stories fit in the context window of the story model,
+    since the quality of the stories quickly degrades past it. Groups of one situation should use story_prompt().
+
+    :param situations: the situations to group.
+    :return: the list of groups, in the same order as situations.
+    """
+    batches = list()
+    for situation in situations:
+        if batches:
+            candidate = batches[-1] + [situation]
+            needed = estimate_tokens(batch_story_prompt(candidate)) + sum(map(story_tokens, candidate))
+            if needed <= STORY_MODEL_CONTEXT:
+                batches[-1] = candidate
+                continue
+        batches.append([situation])
+    return batches
+
+
+def attempt_tokens(tokens, attempts, context):
+    """Raises the maximum number of tokens of a response at each new attempt, in case it was cut off.
+
+    :param tokens: the maximum number of tokens of the first attempt.
+    :param attempts: the number of previous attempts.
+    :param context: the context window of the model, which the response can't exceed.
+    :return: the maximum number of tokens of this attempt.
+    """
+    return min(tokens * (attempts + 1), context)
+
+
+async def retry(description, attempt):
+    """Runs an attempt at generating something until it succeeds, at most MAX_RETRIES times.
+
+    Only the failing generation is retried, so a bad response doesn't waste the ones already generated.
+
+    :param description: what is generated, printed when an attempt fails.
+    :param attempt: the coroutine function making an attempt, called with the number of previous attempts.
+    :return: the result of the first successful attempt.
+    """
+    for i in range(MAX_RETRIES):
         try:
-            for situation in situations:
-                print(f"# Situation {situations.index(situation)}")
-                prompt = f"Create a story based on this question: {situation.question}. The possible answers are:\n"
-                # List of possible answers. The number of answers is undefined, hence the for loop.
-                for i in range(len(situation.answers)):
-                    prompt += f"{i}. {situation.answers[i]}\n"
-
-                prompt += f"The correct answer is {situation.correct_answer} and is the only one to lead to a good ending. " \
-                          f"The other answers are wrong answers and must always lead to a bad ending, with severe " \
-                          f"consequences for all the characters involved. Write the story with an introduction, leading to " \
-                          f"the choice to make. You have to write all the different endings each option lead to. Do not reword " \
-                          f"the choices. The good ending must be at least 3 paragraphs long. The story must be " \
-                          f"written in a third person point of view. The story must be more dialogue than description " \
-                          f"because it is a visual novel. For each line, one character can talk at most. The format " \
-                          f"should be markdown. After finishing the story, " \
-                          f"list all the dialogues with the speakers name, preferably in a table." \
-                          f"The format of the story should be this " \
-                          f"(replace each part of the format by the corresponding element):\n" \
-                          "## Introduction\n"
-
-                # Better results if we're explicitly asking for each answer
-
-                for i in range(len(situation.answers)):
-                    prompt += f"## Ending with answer {i}\n"
-                prompt += "## Dialogues\n"
-                # Gemma 2 gives better sounding stories in our opinion and has a more consistent format
-                response = ollama_client.chat(
-                    model="gemma2:9b",
-                    messages=[
-                        {
-                            'role': 'system',
-                            'content': "Paragraphs must be no longer than 40 words."
-                        },
-                        {
-                            'role': 'user',
-                            'content': prompt
-                        }
-                    ],
-                    options={
-                        'top_p': 0.75
-                    }
-                )
-                situation.parse(response["message"]["content"])
-
-                # Generating prompts for the background images.
-                # It should be very
-                str_intro = "\n".join([str(x) for x in situation.introduction])
-                prompt = f"Describe where this scene takes place. You must describe the " \
-                         f"location of the scene with what the reader might imagine, in a neutral way. You must be " \
-                         f"objective, not subjective. Don't write sentences, " \
-                         f"only keywords. You are not allowed to write keywords that refer to people, humans, " \
-                         f"or body:\n{str(str_intro)}"
-                response = ollama_client.chat(
-                    model="llama3:8b",
-                    messages=[
-                        {
-                            "role": "system",
-                            "content": "Respond with 70 words or less. You are not allowed to write keywords that "
-                                       "refer to people, humans, or body. You must only write the keywords."
-                        },
-                        {
-                            "role": "user",
-                            "content": prompt
-                        }
-                    ],
-                    options={
-                        "top_p": 0.1,
-                        "temperature": 0.1
+            return await attempt(i)
+        except Exception:
+            traceback.print_exc(file=sys.stderr)
+            if i + 1 == MAX_RETRIES:
+                raise
+            print(f"Retrying {description}...", file=sys.stderr)
+
+
+async def chat(client, semaphore, description, check=None, **kwargs):
+    """Sends a chat request to Ollama and streams its response, unless the same request was already answered.
+
+    Streaming shows when the model starts answering, and the timeout of the client then applies between two chunks of
+    the response instead of to the whole response. The response is saved in RESPONSE_CACHE_DIR, so that the request
+    isn't sent again if the run is interrupted and started over.
+
+    :param client: the Ollama client.
+    :type client: AsyncClient
+    :param semaphore: limits the number of requests sent to Ollama at the same time.
+    :type semaphore: asyncio.Semaphore
+    :param description: what is generated, printed when the first chunk of the response arrives.
+    :param check: called with the response, raises an exception if it can't be used. Such a response isn't saved, so
+        that the request is sent again when retried.
+    :param kwargs: the arguments of AsyncClient.chat().
+    :return: the content of the response.
+    """
+    key = hashlib.sha256(json.dumps(kwargs, sort_keys=True).encode()).hexdigest()
+    path = f"{RESPONSE_CACHE_DIR}/{key}.txt"
+    # The responses can contain lone surrogates, which are only removed when they are parsed.
+    if os.path.exists(path):
+        print(f"Reusing {description}")
+        with open(path, encoding="utf8", errors="surrogatepass", newline="") as f:
+            response = f.read()
+        if check is not None:
+            try:
+                check(response)
+            except Exception:
+                os.remove(path)
+                raise
+        return response
+
+    loaded_models.add(kwargs["model"])
+    async with semaphore:
+        parts = list()
+        chunk = dict()
+        async for chunk in await client.chat(stream=True, keep_alive=KEEP_ALIVE, **kwargs):
+            if not parts:
+                print(f"Receiving {description}")
+            parts.append(chunk["message"]["content"])
+    # The last chunk tells why the response ended. A response cut off by num_predict is incomplete, so it isn't saved.
+    if chunk.get("done_reason") == "length":
+        raise ValueError(f"The response for {description} was cut off after {kwargs['options']['num_predict']} tokens")
+    response = "".join(parts)
+    if check is not None:
+        check(response)
+
+    # Written under another name first, so that an interrupted run doesn't leave a truncated response.
+    os.makedirs(RESPONSE_CACHE_DIR, exist_ok=True)
+    with open(f"{path}.tmp", "w", encoding="utf8", errors="surrogatepass", newline="") as f:
+        f.write(response)
+    os.replace(f"{path}.tmp", path)
+    return response
+
+
+async def unload(client, model):
+    """Unloads a model from Ollama, to make room for the next ones.
+
+    Nothing is done if the model wasn't used, for instance when all of its responses were saved by a previous run. A
+    failure is only printed, since the model is unloaded anyway once KEEP_ALIVE is over.
+
+    :param client: the Ollama client.
+    :type client: AsyncClient
+    :param model: the name of the model.
+    """
+    if model not in loaded_models:
+        return
+    try:
+        await client.generate(model=model, keep_alive=0)
+    except Exception:
+        traceback.print_exc(file=sys.stderr)
+    loaded_models.discard(model)
+
+
+async def generate_stories(client, semaphore, first, batch):
+    """Generates and parses the stories of a group of situations made by story_batches().
+
+    :param client: the Ollama client.
+    :type client: AsyncClient
+    :param semaphore: limits the number of requests sent to Ollama at the same time.
+    :type semaphore: asyncio.Semaphore
+    :param first: the index of the first situation of batch, used to print the progress.
+    :param batch: the situations to generate the stories of.
+    """
+    remaining = list(enumerate(batch, first))
+    if len(batch) > 1:
+        print(f"# Situations {first} to {first + len(batch) - 1}")
+        try:
+            response = await chat(
+                client, semaphore, f"situations {first} to {first + len(batch) - 1}",
+                model="gemma2:9b",
+                messages=[
+                    {
+                        'role': 'system',
+                        'content': "Paragraphs must be no longer than 40 words."
+                    },
+                    {
+                        'role': 'user',
+                        'content': batch_story_prompt(batch)
                     }
-                )
-                print(response["message"]["content"])
-                background_prompts.append(response["message"]["content"])
+                ],
+                options={
+                    'top_p': 0.75,
+                    'num_ctx': STORY_MODEL_CONTEXT,
+                    'num_predict': sum(map(story_tokens, batch))
+                }
+            )
+            stories = split_story_batch(response)
+        except Exception:
+            # The stories are generated one by one instead, each with its own retries.
+            traceback.print_exc(file=sys.stderr)
+            stories = dict()
+        remaining = list()
+        for i, situation in enumerate(batch):
+            try:
+                situation.parse(stories[i])
+            except Exception:
+                # This story is missing or badly formatted, it is generated again on its own.
+                traceback.print_exc(file=sys.stderr)
+                remaining.append((first + i, situation))
+
+    await asyncio.gather(*[generate_story(client, semaphore, idx, situation) for idx, situation in remaining])
+
+
+async def generate_story(client, semaphore, idx, situation):
+    """Generates and parses the story of a single situation.
+
+    :param client: the Ollama client.
+    :type client: AsyncClient
+    :param semaphore: limits the number of requests sent to Ollama at the same time.
+    :type semaphore: asyncio.Semaphore
+    :param idx: the index of the situation, used to print the progress.
+    :param situation: the situation to generate the story of.
+    """
+    print(f"# Situation {idx}")
+
+    async def attempt(attempts):
+        # Gemma 2 gives better sounding stories in our opinion and has a more consistent format. A badly formatted story
+        # fails to be parsed, and is generated again.
+        await chat(
+            client, semaphore, f"situation {idx}", check=situation.parse,
+            model="gemma2:9b",
+            messages=[
+                {
+                    'role': 'system',
+                    'content': "Paragraphs must be no longer than 40 words."
+                },
+                {
+                    'role': 'user',
+                    'content': story_prompt(situation)
+                }
+            ],
+            options={
+                'top_p': 0.75,
+                'num_ctx': STORY_MODEL_CONTEXT,
+                'num_predict': attempt_tokens(story_tokens(situation), attempts, STORY_MODEL_CONTEXT)
+            }
+        )
 
-            # Generating transitions
-            transitions = list()
-            print("Generating transitions")
-            for i in range(len(situations) - 1):
-                str_intro = '\n'.join([str(x) for x in situations[i + 1].introduction])
-                # Compiling the correct path of the 1st story.
-                prompt = "Write a transition between these two texts. They are part of the same story. The narrator is the " \
-                         "same person. Write only the transition of the story. The transition must feel natural. The first " \
-                         "text describes events happening before those of the second text.\n" \
-                         f"Here is the first text: '{situations[i].good_story}'\n\n" \
-                         f"Here is the second text: '{str_intro}'"
-
-                # Using llama3 because it's better at actually giving a chronological transition.
-                response = ollama_client.chat(
-                    model="llama3:8b",
-                    messages=[
-                        {
-                            'role': 'system',
-                            'content': 'Paragraphs must be no longer than 40 words.'
-                        },
-                        {
-                            'role': 'user',
-                            'content': prompt
-                        }
-                    ],
-                    options={
-                        'top_p': 0.8
-                    }
-                )
-
-                transition = response["message"]["content"].encode("utf-8", "ignore").decode(
-                    "utf-8").replace("\"", "\\\"")
-                transitions.append(transition)
-            break
-        except Exception as e:
-            print(traceback.print_exc(file=sys.stderr))
-            print("Retrying...", file=sys.stderr)
-            situations = list()
-            transitions = list()
-            background_prompts = list()
-
-    print("Generating backgrounds")
+    await retry(f"situation {idx}", attempt)
+
+
+async def generate_background_prompt(client, semaphore, idx, situation, background_queue):
+    """Generates the prompt for the background image of a situation.
+
+    :param client: the Ollama client.
+    :type client: AsyncClient
+    :param semaphore: limits the number of requests sent to Ollama at the same time.
+    :type semaphore: asyncio.Semaphore
+    :param idx: the index of the situation.
+    :param situation: the situation to describe the place of. Its story must have been parsed.
+    :param background_queue: where (idx, prompt) is put for generate_backgrounds().
+    :type background_queue: queue.Queue
+    :return: keywords describing where the introduction of the situation takes place.
+    """
+    # It should be very
+    prompt = f"Describe where this scene takes place. You must describe the " \
+             f"location of the scene with what the reader might imagine, in a neutral way. You must be " \
+             f"objective, not subjective. Don't write sentences, " \
+             f"only keywords. You are not allowed to write keywords that refer to people, humans, " \
+             f"or body:\n{situation.introduction_text}"
+
+    async def attempt(attempts):
+        return await chat(
+            client, semaphore, "a background prompt",
+            model="llama3:8b",
+            messages=[
+                {
+                    "role": "system",
+                    "content": "Respond with 70 words or less. You are not allowed to write keywords that "
+                               "refer to people, humans, or body. You must only write the keywords."
+                },
+                {
+                    "role": "user",
+                    "content": prompt
+                }
+            ],
+            options={
+                "top_p": 0.1,
+                "temperature": 0.1,
+                "num_ctx": LLAMA3_CONTEXT,
+                "num_predict": attempt_tokens(BACKGROUND_PROMPT_TOKENS, attempts, LLAMA3_CONTEXT)
+            }
+        )
+
+    response = await retry("a background prompt", attempt)
+    print(response)
+    background_queue.put((idx, response))
+    return response
+
+
+async def generate_transition(client, semaphore, previous, following):
+    """Generates the transition between the good ending of a situation and the introduction of the next one.
+
+    :param client: the Ollama client.
+    :type client: AsyncClient
+    :param semaphore: limits the number of requests sent to Ollama at the same time.
+    :type semaphore: asyncio.Semaphore
+    :param previous: the situation before the transition. Its story must have been parsed.
+    :param following: the situation after the transition. Its story must have been parsed.
+    :return: the transition, with its quotes escaped.
+    """
+    # Compiling the correct path of the 1st story.
+    prompt = "Write a transition between these two texts. They are part of the same story. The narrator is the " \
+             "same person. Write only the transition of the story. The transition must feel natural. The first " \
+             "text describes events happening before those of the second text.\n" \
+             f"Here is the first text: '{previous.good_story}'\n\n" \
+             f"Here is the second text: '{following.introduction_text}'"
+
+    async def attempt(attempts):
+        # Using llama3 because it's better at actually giving a chronological transition.
+        return await chat(
+            client, semaphore, "a transition",
+            model="llama3:8b",
+            messages=[
+                {
+                    'role': 'system',
+                    'content': 'Paragraphs must be no longer than 40 words.'
+                },
+                {
+                    'role': 'user',
+                    'content': prompt
+                }
+            ],
+            options={
+                'top_p': 0.8,
+                'num_ctx': LLAMA3_CONTEXT,
+                'num_predict': attempt_tokens(TRANSITION_TOKENS, attempts, LLAMA3_CONTEXT)
+            }
+        )
+
+    response = await retry("a transition", attempt)
+
+    # Lone surrogates can't be written to the UTF-8 script. Removing them with a regex returns the response itself when
+    # there are none, instead of encoding and decoding the whole response every time.
+    transition = SURROGATE_RE.sub("", response).replace("\"", "\\\"")
+    # The blank lines between paragraphs would only be skipped when writing the script.
+    return BLANK_LINES_RE.sub("\n", transition).strip("\n")
+
+
+def generate_backgrounds(background_queue, images_dir, texts_done):
+    """Generates the background images with Stable Diffusion 3, as their prompts are put in background_queue.
+
+    Meant to run in its own thread while the texts are generated, so that the model is loaded and the images are
+    generated while waiting for Ollama.
+
+    :param background_queue: the (index, prompt) of each background, then None once all of them are queued.
+    :type background_queue: queue.Queue
+    :param images_dir: the directory where the images are saved, as bg0.png, bg1.png...
+    :param texts_done: set once the texts are generated and Ollama unloaded its models.
+    :type texts_done: threading.Event
+    """
+    print("Loading Stable Diffusion 3")
     # initializing Stable Diffusion 3
+    # bfloat16 takes as much memory as float16, but has the range of float32 so its activations can't overflow.
+    # The attention already goes through torch's scaled_dot_product_attention, which uses FlashAttention when it can.
     pipe = StableDiffusion3Pipeline.from_pretrained(
         "stabilityai/stable-diffusion-3-medium-diffusers",
-        torch_dtype=torch.float16
+        torch_dtype=torch.bfloat16
     )
-    pipe = pipe.to("cuda")
-    for i in range(len(background_prompts)):
-        image = pipe(
-            prompt=f'anime background image of {background_prompts[i]}',
-            negative_prompt="humans, bad anatomy, people, person, character, characters",
-            num_inference_steps=50,
-            height=576,
-            width=1024,
-            guidance_scale=7
-        ).images[0]
-
-        image.save(f"bg{i}.png")
+    # Decoding the 1024 pixels wide images one by one and tile by tile bounds the memory used by the VAE.
+    pipe.vae.enable_slicing()
+    pipe.vae.enable_tiling()
+    # Whether each model of the pipeline is only moved to the GPU while it runs, and whether the pipeline stays where it
+    # is for the remaining batches.
+    offloaded = False
+    placed = False
+
+    done = False
+    while not done:
+        # Waiting for a prompt, then taking the ones already waiting with it, up to a batch small enough to fit in
+        # VRAM so that several images are denoised together.
+        batch = [background_queue.get()]
+        while len(batch) < BACKGROUND_BATCH_SIZE and not background_queue.empty():
+            batch.append(background_queue.get())
+        if None in batch:
+            done = True
+            batch.remove(None)
+        if not batch:
+            continue
+
+        # Ollama shares the GPU while the texts are generated, so the pipeline only goes to VRAM if there is room for
+        # it when the first batch comes. If it doesn't, it is moved there once Ollama unloaded its models.
+        if not placed and (not offloaded or texts_done.is_set()):
+            final = texts_done.is_set()
+            if offloaded:
+                pipe.remove_all_hooks()
+            free_vram, _ = torch.cuda.mem_get_info()
+            offloaded = free_vram < SD3_VRAM
+            if offloaded:
+                pipe.enable_model_cpu_offload()
+            else:
+                pipe = pipe.to("cuda")
+                # The images always have the same size, so the denoiser and the VAE decoder can be compiled for it,
+                # and the CUDA graph of the denoiser replayed at every step. The decoder doesn't use CUDA graphs, since
+                # slicing and tiling call it several times before its outputs are put together, and each call would
+                # overwrite the output of the previous one.
+                # The first batch pays for the compilation. torch.compile needs Triton, which isn't available on
+                # Windows, and the offloading hooks would break its graphs.
+                if importlib.util.find_spec("triton") is not None:
+                    torch.set_float32_matmul_precision("high")
+                    pipe.transformer = torch.compile(pipe.transformer, mode="reduce-overhead", fullgraph=True)
+                    pipe.vae.decoder = torch.compile(pipe.vae.decoder, fullgraph=True)
+            # Once the texts are done, there is nothing left to free.
+            placed = final or not offloaded
+
+        print(f"Generating backgrounds {', '.join(str(i) for i, _ in batch)}")
+        with torch.inference_mode():
+            images = pipe(
+                prompt=[f'anime background image of {prompt}' for _, prompt in batch],
+                negative_prompt=["humans, bad anatomy, people, person, character, characters"] * len(batch),
+                num_inference_steps=50,
+                height=576,
+                width=1024,
+                guidance_scale=7
+            ).images
+
+        for (i, _), image in zip(batch, images):
+            image.save(f"{images_dir}/bg{i}.png")
 
     # Getting rid of the pipeline to save VRAM
     del pipe
     torch.cuda.empty_cache()
 
-    print("Getting character list")
 
-    all_characters = list()
-    for situation in situations:
-        for character in situation.characters:
-            if character not in all_characters:
-                all_characters.append(character)
+async def main():
+    # reading questions
+    questions_yaml = load_questions("questions.yaml")
+
+    # Parsing the YAML file.
+    situations = [
+        Situation(question, correct_answer, tuple(answers))
+        for question, answers, correct_answer in map(SITUATION_FIELDS, questions_yaml['situations'])
+    ]
+
+    # Instanciating the ollama client.
+    # 20 minutes of timeout between two chunks
+    ollama_client = AsyncClient(host="http://localhost:11434", timeout=20 * 60)
+    # Ollama only serves OLLAMA_NUM_PARALLEL requests at the same time, the other ones would wait in its queue.
+    semaphore = asyncio.Semaphore(int(os.environ.get("OLLAMA_NUM_PARALLEL", 4)))
 
-    print("Extracting base game")
+    # The base game is copied first so that the background images can be saved right into it.
+    print("Copying base game")
 
     t = int(time())
     game_name = f"vnai-{t}"
-    with zipfile.ZipFile("base.zip", "r") as f:
-        f.extractall(game_name)
+    copy_base_game(game_name)
+
+    # The background images are generated in another thread, as soon as their prompts are ready.
+    background_queue = queue.Queue()
+    texts_done = threading.Event()
+    backgrounds_task = asyncio.create_task(asyncio.to_thread(
+        generate_backgrounds, background_queue, f"{game_name}/base/game/images", texts_done
+    ))
+
+    try:
+        # Each request is retried on its own if it fails. All the requests to a model are sent before the ones to the
+        # next model, so that Ollama doesn't have to swap them.
+        try:
+            # Generating a story for each situation, with Gemma 2.
+            story_batch_coroutines = list()
+            first = 0
+            for batch in story_batches(situations):
+                story_batch_coroutines.append(generate_stories(ollama_client, semaphore, first, batch))
+                first += len(batch)
+            await asyncio.gather(*story_batch_coroutines)
+            await unload(ollama_client, "gemma2:9b")
+
+            # Generating the background prompts and the transitions, with Llama 3.
+            print("Generating transitions")
+            background_coroutines = [
+                generate_background_prompt(ollama_client, semaphore, i, situations[i], background_queue)
+                for i in range(len(situations))
+            ]
+            transition_coroutines = [
+                generate_transition(ollama_client, semaphore, situations[i], situations[i + 1])
+                for i in range(len(situations) - 1)
+            ]
+            results = await asyncio.gather(*background_coroutines, *transition_coroutines)
+            transitions = results[len(background_coroutines):]
+            await unload(ollama_client, "llama3:8b")
+            texts_done.set()
+        finally:
+            # Even when the texts fail, so that the thread doesn't wait for more prompts forever.
+            background_queue.put(None)
+
+        await backgrounds_task
+    except BaseException:
+        # The unfinished game is removed, so that failed or interrupted runs don't leave it behind. The prompts still
+        # waiting are dropped, and the thread is waited for so that it doesn't save an image into the removed directory.
+        while not background_queue.empty():
+            background_queue.get_nowait()
+        background_queue.put(None)
+        await asyncio.gather(backgrounds_task, return_exceptions=True)
+        shutil.rmtree(game_name, ignore_errors=True)
+        raise
+
+    print("Getting character list")
+
+    # Index of each character, by name, in the order they are registered in the script.
+    all_characters = dict()
+    for situation in situations:
+        for character in situation.characters:
+            all_characters.setdefault(character, len(all_characters))
 
     print("Configuring the game")
     with open(f"{game_name}/base/game/options.rpy", "a") as f:
         f.write(f'define config.save_directory = "{game_name}"')
 
-    for i in range(len(situations)):
-        os.rename(f"bg{i}.png", f"{game_name}/base/game/images/bg{i}.png")
-
     print("Generating the script")
 
-    with open(f"{game_name}/base/game/script.rpy", "a", encoding="utf8") as f:
-        # Registering characters
-        for i in range(len(all_characters)):
-            f.write(f'define c{i} = Character("{all_characters[i]}")\n')
-
-        f.write("label start:\n")
-        f.write("    jump story0\n")
-
-        # Writing each situation
-        for i in range(len(situations)):
-            print(f"Writing situation {i}")
-            f.write(f"label story{i}:\n")
-            f.write(f"    scene bg{i} at image_upscale\n")
-            f.write(f"    with dissolve\n")
-
-            # Introduction
-            for line in situations[i].introduction:
-                f.write(f'    {line.renpy_line(all_characters)}\n')
-
-            # Choice
-            f.write("    menu:\n")
-            for j in range(len(situations[i].answers)):
-                answer = situations[i].answers[j]
-                f.write(f'        "{answer}":\n')
-                f.write(f'            jump s{i}a{j}\n')
-
-            # Endings
-            for j in range(len(situations[i].endings)):
-                f.write(f"label s{i}a{j}:\n")
-                for line in situations[i].endings[j]:
-                    f.write(f'    {line.renpy_line(all_characters)}\n')
-
-                if j == situations[i].correct_answer_index:
-                    if i + 1 == len(situations):
-                        f.write("    jump ending\n")
-                    else:
-                        for line in transitions[i].split('\n'):
-                            f.write(f'    "{line}"\n')
-                        f.write(f"    jump story{i+1}\n")
-                else:
-                    f.write(f"    jump story{i}\n")
-
-
-        # final ending
-        f.write(
-            "label ending:\n"
-            '    "Thanks for playing!"\n'
-        )
+    # The script of the base game already starts with a UTF-8 BOM, so it can be appended to as is.
+    with open(f"{game_name}/base/game/script.rpy", "a", encoding="utf8", newline="\n") as f:
+        f.write(SCRIPT_TEMPLATE.render(characters=all_characters, situations=situations, transitions=transitions))
 
-        f.flush()
-        os.fsync(f.fileno())
-
-    os.system(f'powershell -command "Get-Content .\\{game_name}\\base\\game\\script.rpy | Set-Content -Encoding utf8 .\\{game_name}\\base\\game\\script-tmp.rpy"')
-    os.remove(f"{game_name}/base/game/script.rpy")
-    os.rename(f"{game_name}/base/game/script-tmp.rpy", f"{game_name}/base/game/script.rpy")
+    # The game is generated, the next run starts over with new responses.
+    shutil.rmtree(RESPONSE_CACHE_DIR, ignore_errors=True)
 
     print("Compiling game...")
     os.chdir("renpy")
     os.system(f".\\lib\\py3-windows-x86_64\\python.exe renpy.py ..\\{game_name}\\base compile && "
               f".\\lib\\py3-windows-x86_64\\python.exe renpy.py launcher distribute ..\\{game_name}\\base "
               f"--destination ..\\out\\{game_name} --package pc")
+
+
+if __name__ == '__main__':
+    asyncio.run(main())